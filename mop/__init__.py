@@ -1,3 +1,14 @@
+import os
+import random
+import sys
+import weakref
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 # Phase 0: absolute basics that we must start with
 
 # things that must be provided by the underlying system: a place to store the
@@ -9,9 +20,47 @@ Method    = None
 Attribute = None
 
 class BasicInstance(object):
-    def __init__(self, metaclass, slots):
+    def __init__(self, metaclass, slots, oid=None):
         self.metaclass = metaclass
         self.slots = slots
+        if oid is None:
+            oid = OID_ALLOCATOR()
+        self.oid = oid
+
+# every instance also gets an integer object id, which is kept when the
+# instance is stored and loaded again. attributes which store their values
+# outside of the instance should key them on (instance.oid, attribute name).
+# by default, ids are a random 31 bit prefix chosen once per process followed
+# by a 32 bit counter, so they fit in a signed 64 bit integer, are never
+# reused within a process (unlike python's id()), and are unlikely to collide
+# with ids from other processes or earlier runs. the allocator can also be
+# replaced by one backed by persistent storage, if that isn't good enough.
+def process_oids():
+    rng = random.SystemRandom()
+    while True:
+        prefix = rng.getrandbits(31) << 32
+        for counter in range(1, 1 << 32):
+            yield prefix | counter
+
+OID_ALLOCATOR = None
+DEFAULT_OID_ALLOCATOR = None
+
+def reset_default_oid_allocator():
+    global OID_ALLOCATOR, DEFAULT_OID_ALLOCATOR
+    if OID_ALLOCATOR is DEFAULT_OID_ALLOCATOR:
+        OID_ALLOCATOR = DEFAULT_OID_ALLOCATOR = process_oids().__next__
+
+reset_default_oid_allocator()
+# forked children would otherwise carry on allocating from the parent's
+# sequence
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_default_oid_allocator)
+
+def set_oid_allocator(allocator):
+    global OID_ALLOCATOR
+    previous = OID_ALLOCATOR
+    OID_ALLOCATOR = allocator
+    return previous
 
 def execute_method(body, invocant, args, kwargs):
     return body(invocant, *args, **kwargs)
@@ -20,20 +69,135 @@ def execute_method(body, invocant, args, kwargs):
 # necessary, but this allows us to pass python-level method calls through to
 # our mop infrastructure
 UNDERLYING_CLASSES = {}
+
+# the oids of each class's ancestors, keyed by the class's oid. this is kept
+# out here rather than in a slot so that isa can get at it with a single dict
+# lookup, and it holds oids rather than the classes themselves so that it
+# doesn't keep any classes alive
+ANCESTORS = {}
+
+# the oids of the roles each class does, including those composed into its
+# ancestors, kept in the same way as the ancestors
+ROLES = {}
+
+# weak references to the classes which have entries in the caches above,
+# whose callbacks remove those entries again once the class goes away
+CACHED_CLASSES = {}
+
+def python_forget_when_collected(c):
+    oid = c.oid
+    if oid not in CACHED_CLASSES:
+        def forget(ref):
+            CACHED_CLASSES.pop(oid, None)
+            ANCESTORS.pop(oid, None)
+            ROLES.pop(oid, None)
+        CACHED_CLASSES[oid] = weakref.ref(c, forget)
+
 def python_class_for(c, name=None):
-    key = hash(c)
+    key = c.oid
     if key not in UNDERLYING_CLASSES.keys():
         if name is None:
             name = c.name()
         UNDERLYING_CLASSES[key] = type(name, (object,), {})
     return UNDERLYING_CLASSES[key]
 
-def python_install_method(c, name, method):
-    setattr(
-        python_class_for(c),
-        name,
-        lambda self, *args, **kwargs: method.execute(self, args, kwargs)
-    )
+def python_install_method(c, name, method, modifiers=None):
+    if modifiers:
+        body = python_compose_method(method, modifiers)
+    else:
+        body = lambda self, *args, **kwargs: method.execute(self, args, kwargs)
+    setattr(python_class_for(c), name, body)
+
+def python_install_methods(c, methods, modifiers):
+    for name in modifiers:
+        if name not in methods:
+            raise Exception("can't modify nonexistent method " + name)
+    for method in methods.values():
+        name = method.name()
+        python_install_method(c, name, method, modifiers.get(name))
+
+# the computed attributes currently being evaluated, as a stack of (instance,
+# dependencies) pairs. reading an attribute of the instance on the top of the
+# stack records that attribute as a dependency of the computed value.
+COMPUTING = []
+
+# the computed attributes which have read each attribute while calculating
+# their value, keyed by the oid of the attribute that was read. the entry goes
+# away along with the attribute, and doesn't keep the computed attributes
+# alive either.
+DEPENDENTS = {}
+
+# dependency tracking hooks into the value and set_value of attributes, but
+# only attributes of classes which actually have computed attributes need
+# it, so those attributes are switched over to a subclass of their usual
+# python class which adds the hooks, and every other attribute keeps calling
+# its methods directly. the hooks call whatever value and set_value the
+# attribute class ends up with, so attribute classes which override them
+# still take part.
+TRACKING_CLASSES = {}
+
+def python_tracking_class_for(c):
+    key = c.oid
+    if key not in TRACKING_CLASSES.keys():
+        python_class = python_class_for(c)
+
+        def value(self, instance, *args, **kwargs):
+            if COMPUTING and COMPUTING[-1][0] is instance:
+                COMPUTING[-1][1].add(self)
+            return python_class.value(self, instance, *args, **kwargs)
+
+        def set_value(self, instance, *args, **kwargs):
+            python_class.set_value(self, instance, *args, **kwargs)
+            dependents = DEPENDENTS.get(self.oid)
+            if dependents:
+                for dependent in list(dependents):
+                    dependent.dependency_changed(self, instance)
+
+        TRACKING_CLASSES[key] = type(python_class.__name__, (python_class,), {
+            "value": value,
+            "set_value": set_value,
+        })
+    return TRACKING_CLASSES[key]
+
+def python_track_attributes(c):
+    for attr in c.all_attributes().values():
+        tracking_class = python_tracking_class_for(attr.metaclass)
+        if attr.__class__ is not tracking_class:
+            attr.__class__ = tracking_class
+
+# method modifiers are flattened into a single python function when the class
+# is finalized, so calling a modified method is just a chain of plain function
+# calls around the one call to method.execute, rather than a separate trip
+# through the mop for each modifier. as in other systems with modifiers, the
+# most recently added before modifier runs first, after modifiers run in the
+# order they were added, and the most recently added around modifier is the
+# outermost one.
+def python_compose_method(method, modifiers):
+    def body(self, *args, **kwargs):
+        return method.execute(self, args, kwargs)
+
+    def wrap_around(orig, around):
+        return lambda self, *args, **kwargs: around(orig, self, *args, **kwargs)
+    for around in modifiers["around"]:
+        body = wrap_around(body, around)
+
+    befores = list(reversed(modifiers["before"]))
+    afters = list(modifiers["after"])
+    if befores or afters:
+        inner = body
+        def body(self, *args, **kwargs):
+            for before in befores:
+                execute_method(before, self, args, kwargs)
+            result = inner(self, *args, **kwargs)
+            for after in afters:
+                execute_method(after, self, args, kwargs)
+            return result
+
+    return body
+
+# instance accounting for each class which has it enabled, keyed by the
+# class's oid
+ACCOUNTING = {}
 
 def bootstrap():
     # Phase 1: construct the core classes
@@ -46,6 +210,10 @@ def bootstrap():
                 "superclass": superclass,
                 "methods": {},
                 "attributes": {},
+                "modifiers": {},
+                "subclasses": weakref.WeakSet(),
+                "roles": [],
+                "migrations": [],
             },
         )
 
@@ -185,6 +353,8 @@ def bootstrap():
     ))
 
     # new requires create_instance
+    # this create_instance implementation is temporary too - we replace it
+    # once the rest of the mop is in place, to add instance accounting
     def create_instance(self, kwargs):
         instance = BasicInstance(self, {})
         instance.__class__ = python_class_for(self)
@@ -254,6 +424,12 @@ def bootstrap():
     Class.add_attribute(Attribute(name="superclass"))
     Class.add_attribute(Attribute(name="attributes", default=lambda: {}))
     Class.add_attribute(Attribute(name="methods", default=lambda: {}))
+    Class.add_attribute(Attribute(name="modifiers", default=lambda: {}))
+    Class.add_attribute(Attribute(
+        name="subclasses", default=lambda: weakref.WeakSet()
+    ))
+    Class.add_attribute(Attribute(name="roles", default=lambda: []))
+    Class.add_attribute(Attribute(name="migrations", default=lambda: []))
 
     Class.add_method(Method(
         name="name", body=gen_reader("name")
@@ -272,30 +448,380 @@ def bootstrap():
         name="all_methods", body=all_methods
     ))
 
+    Class.add_method(Method(
+        name="local_modifiers", body=gen_reader("modifiers")
+    ))
+
+    def add_method_modifier(self, kind, name, body):
+        modifiers = self.local_modifiers()
+        if name not in modifiers:
+            modifiers[name] = { "before": [], "after": [], "around": [] }
+        modifiers[name][kind].append(body)
+    Class.add_method(Method(
+        name="add_method_modifier", body=add_method_modifier
+    ))
+
+    # before and after modifiers are called with the same arguments as the
+    # method itself, and around modifiers are called with the original method
+    # followed by those arguments
+    def gen_modifier(kind):
+        return lambda self, name, body: self.add_method_modifier(kind, name, body)
+
+    Class.add_method(Method(
+        name="before", body=gen_modifier("before")
+    ))
+    Class.add_method(Method(
+        name="after", body=gen_modifier("after")
+    ))
+    Class.add_method(Method(
+        name="around", body=gen_modifier("around")
+    ))
+
+    def all_modifiers(self):
+        modifiers = {}
+        for c in reversed(self.mro()):
+            # overriding a method in a subclass also drops any modifiers that
+            # were applied to the superclass's version of it
+            for name in c.local_methods():
+                modifiers.pop(name, None)
+            for name, local in c.local_modifiers().items():
+                if name not in modifiers:
+                    modifiers[name] = { "before": [], "after": [], "around": [] }
+                for kind in modifiers[name]:
+                    modifiers[name][kind].extend(local[kind])
+        return modifiers
+    Class.add_method(Method(
+        name="all_modifiers", body=all_modifiers
+    ))
+
     Class.add_method(Method(
         name="attribute_class", body=lambda self: Attribute
     ))
     Class.add_method(Method(
         name="method_class", body=lambda self: Method
     ))
+    Class.add_method(Method(
+        name="computed_attribute_class", body=lambda self: ComputedAttribute
+    ))
     Class.add_method(Method(
         name="base_object_class", body=lambda self: Object
     ))
 
     def finalize(self):
-        for method in self.all_methods().values():
-            python_install_method(self, method.name(), method)
+        python_install_methods(self, self.all_methods(), self.all_modifiers())
     Class.add_method(Method(
         name="finalize", body=finalize
     ))
 
+    # builds and finalizes a whole class in one go. nothing else can see the
+    # new class until it is returned, so if anything goes wrong along the way,
+    # we just have to throw away the bits of it that were registered elsewhere
+    def define(self, name, superclass=None, attributes=None, methods=None, **kwargs):
+        if superclass is None:
+            superclass = self.base_object_class()
+        if attributes is None:
+            attributes = {}
+        if methods is None:
+            methods = {}
+        c = self(name=name, superclass=superclass, **kwargs)
+        try:
+            for attr_name, default in attributes.items():
+                c.add_attribute(c.attribute_class()(
+                    name=attr_name, default=default
+                ))
+            for method_name, body in methods.items():
+                c.add_method(c.method_class()(
+                    name=method_name, body=body
+                ))
+            c.finalize()
+        except:
+            superclass.subclasses().discard(c)
+            ANCESTORS.pop(c.oid, None)
+            UNDERLYING_CLASSES.pop(c.oid, None)
+            raise
+        return c
+    Class.add_method(Method(
+        name="define", body=define
+    ))
+
+    Class.add_method(Method(
+        name="subclasses", body=gen_reader("subclasses")
+    ))
+
+    # the set of ancestors is computed the first time it's needed and then
+    # cached, so that isa doesn't have to walk the whole mro every time.
+    # subclasses register themselves with their superclass when they compute
+    # their own cached set, so that we know whose caches to clear when the
+    # hierarchy changes.
+    def ancestor_ids(self):
+        ancestor_ids = ANCESTORS.get(self.oid)
+        if ancestor_ids is None:
+            ancestor_ids = { self.oid }
+            parent = self.superclass()
+            if parent:
+                ancestor_ids |= parent.ancestor_ids()
+                parent.subclasses().add(self)
+            python_forget_when_collected(self)
+            ancestor_ids = ANCESTORS[self.oid] = frozenset(ancestor_ids)
+        return ancestor_ids
+    Class.add_method(Method(
+        name="ancestor_ids", body=ancestor_ids
+    ))
+
+    Class.add_method(Method(
+        name="local_roles", body=gen_reader("roles")
+    ))
+
+    # cached the same way as the ancestors
+    def role_ids(self):
+        role_ids = ROLES.get(self.oid)
+        if role_ids is None:
+            role_ids = { role.oid for role in self.local_roles() }
+            parent = self.superclass()
+            if parent:
+                role_ids |= parent.role_ids()
+                parent.subclasses().add(self)
+            python_forget_when_collected(self)
+            role_ids = ROLES[self.oid] = frozenset(role_ids)
+        return role_ids
+    Class.add_method(Method(
+        name="role_ids", body=role_ids
+    ))
+
+    # everything is checked before anything is copied, so a role which fails
+    # to compose leaves the class untouched. attributes and methods defined in
+    # the class itself take precedence over those from the role, and those
+    # from the role take precedence over inherited ones, but attributes or
+    # methods which collide with different ones from another role are an
+    # error.
+    def add_role(self, role):
+        if role in self.local_roles():
+            return
+        methods = self.all_methods()
+        for name in role.required_methods():
+            if name not in methods and name not in role.local_methods():
+                raise Exception(
+                    "role " + role.name() + " requires method " + name
+                )
+
+        # a local member which is the same object as the role's is left
+        # alone, and a different one either belongs to the class itself, which
+        # wins, or came from another role, which is a conflict
+        def members_to_add(kind, local_members, members_of):
+            members = []
+            for name, member in members_of(role).items():
+                existing = local_members.get(name)
+                if existing is None:
+                    members.append(member)
+                    continue
+                if existing is member:
+                    continue
+                for other in self.local_roles():
+                    if members_of(other).get(name) is existing:
+                        raise Exception(
+                            "role " + role.name() + " has " + kind + " " +
+                            name + " which conflicts with role " + other.name()
+                        )
+            return members
+        role_attributes = members_to_add(
+            "attribute", self.local_attributes(), lambda r: r.local_attributes()
+        )
+        role_methods = members_to_add(
+            "method", self.local_methods(), lambda r: r.local_methods()
+        )
+
+        for attr in role_attributes:
+            self.add_attribute(attr)
+        for method in role_methods:
+            self.add_method(method)
+        self.local_roles().append(role)
+        self.clear_hierarchy_caches()
+    Class.add_method(Method(
+        name="add_role", body=add_role
+    ))
+
+    def clear_hierarchy_caches(self):
+        classes = [ self ]
+        while classes:
+            c = classes.pop()
+            ANCESTORS.pop(c.oid, None)
+            ROLES.pop(c.oid, None)
+            classes.extend(c.subclasses())
+    Class.add_method(Method(
+        name="clear_hierarchy_caches", body=clear_hierarchy_caches
+    ))
+
+    def set_superclass(self, superclass):
+        parent = self.superclass()
+        if parent:
+            parent.subclasses().discard(self)
+        self.metaclass.all_attributes()["superclass"].set_value(self, superclass)
+        self.clear_hierarchy_caches()
+    Class.add_method(Method(
+        name="set_superclass", body=set_superclass
+    ))
+
+    # here's the better version of create_instance, which replaces the one
+    # from phase 3. it adds instance accounting, which is off by default. its
+    # state lives in a plain dict keyed by oid rather than in a slot, so while
+    # it is off it only costs a single failed dict lookup. it also takes the
+    # oid of an instance being loaded from storage, so that it keeps the
+    # same identity.
+    def create_instance(self, kwargs, oid=None):
+        instance = BasicInstance(self, {}, oid)
+        instance.__class__ = python_class_for(self)
+        attrs = self.all_attributes()
+        for attr_name in attrs:
+            attr = attrs[attr_name]
+            if attr_name in kwargs.keys():
+                attr.set_value(instance, kwargs[attr_name])
+            else:
+                attr.set_value(instance, attr.default_for_instance())
+        accounting = ACCOUNTING.get(self.oid)
+        if accounting is not None:
+            accounting["created"] += 1
+            accounting["live"].add(instance)
+        return instance
+    Class.add_method(Method(
+        name="create_instance", body=create_instance
+    ))
+
+    def enable_accounting(self):
+        if self.oid not in ACCOUNTING:
+            # the entry goes away along with the class
+            oid = self.oid
+            ACCOUNTING[oid] = {
+                "class": weakref.ref(self, lambda c: ACCOUNTING.pop(oid, None)),
+                "created": 0,
+                "live": weakref.WeakSet(),
+            }
+    Class.add_method(Method(
+        name="enable_accounting", body=enable_accounting
+    ))
+
+    def disable_accounting(self):
+        ACCOUNTING.pop(self.oid, None)
+    Class.add_method(Method(
+        name="disable_accounting", body=disable_accounting
+    ))
+
+    # the byte count is only an approximation: it includes the instance, its
+    # slots and the values directly stored in them, but doesn't follow
+    # references any further than that
+    def instance_stats(self):
+        accounting = ACCOUNTING.get(self.oid)
+        if accounting is None:
+            return None
+        live = list(accounting["live"])
+        size = 0
+        for instance in live:
+            size += sys.getsizeof(instance) + sys.getsizeof(instance.__dict__)
+            size += sys.getsizeof(instance.slots)
+            for value in instance.slots.values():
+                size += sys.getsizeof(value)
+        return {
+            "created": accounting["created"],
+            "live": len(live),
+            "bytes": size,
+        }
+    Class.add_method(Method(
+        name="instance_stats", body=instance_stats
+    ))
+
+    # migrations upgrade stored instance data from older versions of a class.
+    # each migration takes the slots for one version and returns the slots
+    # for the next, and the current version of the class is the number of
+    # migrations which have been added to it. instances also hold the slots
+    # of their superclasses' attributes, so their schema is made up of the
+    # versions of every class in the mro.
+    Class.add_method(Method(
+        name="migrations", body=gen_reader("migrations")
+    ))
+
+    def add_migration(self, body):
+        self.migrations().append(body)
+    Class.add_method(Method(
+        name="add_migration", body=add_migration
+    ))
+
+    def schema_version(self):
+        return len(self.migrations())
+    Class.add_method(Method(
+        name="schema_version", body=schema_version
+    ))
+
+    # the versions of each class in the mro which has any migrations, keyed
+    # by class name
+    def schema_versions(self):
+        versions = {}
+        for c in self.mro():
+            version = c.schema_version()
+            if version > 0:
+                versions[c.name()] = version
+        return versions
+    Class.add_method(Method(
+        name="schema_versions", body=schema_versions
+    ))
+
+    # superclass migrations are applied first, since they were written
+    # without knowing about any of their subclasses
+    def migrate(self, slots, versions):
+        for c in reversed(self.mro()):
+            for migration in c.migrations()[versions.get(c.name(), 0):]:
+                slots = migration(slots)
+        return slots
+    Class.add_method(Method(
+        name="migrate", body=migrate
+    ))
+
+    # builds a column-oriented collection of instances of this class, either
+    # from existing instances or directly from a dict of column values
+    def collection(self, instances=(), columns=None):
+        attrs = self.all_attributes()
+        names = [
+            name for name in attrs
+            if not attrs[name].isa(ComputedAttribute)
+        ]
+        if columns is None:
+            instances = list(instances)
+            columns = {
+                name: [ attrs[name].value(i) for i in instances ]
+                for name in names
+            }
+        else:
+            columns = dict(columns)
+            length = len(next(iter(columns.values()))) if columns else 0
+            for name in names:
+                if name not in columns:
+                    columns[name] = [
+                        attrs[name].default_for_instance()
+                        for i in range(length)
+                    ]
+        return Collection(self, {
+            name: make_column(columns[name]) for name in names
+        })
+    Class.add_method(Method(
+        name="collection", body=collection
+    ))
+
     def isa(self, other):
-        mro = self.metaclass.mro()
-        return other in mro
+        ancestor_ids = ANCESTORS.get(self.metaclass.oid)
+        if ancestor_ids is None:
+            ancestor_ids = self.metaclass.ancestor_ids()
+        return getattr(other, "oid", None) in ancestor_ids
     Object.add_method(Method(
         name="isa", body=isa
     ))
 
+    def does(self, role):
+        role_ids = ROLES.get(self.metaclass.oid)
+        if role_ids is None:
+            role_ids = self.metaclass.role_ids()
+        return getattr(role, "oid", None) in role_ids
+    Object.add_method(Method(
+        name="does", body=does
+    ))
+
     def can(self, method_name):
         return self.metaclass.all_methods().get(method_name)
     Object.add_method(Method(
@@ -345,4 +871,305 @@ def bootstrap():
         name="name", body=gen_reader("name")
     ))
 
+    # Phase 7: with the mop complete, we can build extra metaobjects on top of
+    # it in the normal way
+
+    # computed attributes calculate their value from the other attributes of
+    # the instance, and cache it per instance until one of the attributes it
+    # was calculated from is changed
+    global ComputedAttribute
+
+    ComputedAttribute = Class(name="ComputedAttribute", superclass=Attribute)
+    ComputedAttribute.add_attribute(Attribute(name="body"))
+    ComputedAttribute.add_attribute(Attribute(
+        name="cache", default=lambda: weakref.WeakKeyDictionary()
+    ))
+    ComputedAttribute.add_method(Method(
+        name="body", body=gen_reader("body")
+    ))
+    ComputedAttribute.add_method(Method(
+        name="cache", body=gen_reader("cache")
+    ))
+
+    def value(self, instance):
+        cache = self.cache()
+        cached = cache.get(instance)
+        if cached is None:
+            body = self.body()
+            python_track_attributes(instance.metaclass)
+            dependencies = set()
+            COMPUTING.append((instance, dependencies))
+            try:
+                result = execute_method(body, instance, (), {})
+            finally:
+                COMPUTING.pop()
+            for dependency in dependencies:
+                dependents = DEPENDENTS.get(dependency.oid)
+                if dependents is None:
+                    dependents = DEPENDENTS[dependency.oid] = weakref.WeakSet()
+                    weakref.finalize(dependency, DEPENDENTS.pop, dependency.oid, None)
+                dependents.add(self)
+            cached = cache[instance] = (result, dependencies)
+        return cached[0]
+    ComputedAttribute.add_method(Method(
+        name="value", body=value
+    ))
+
+    # computed attributes can't be assigned to, but create_instance calls
+    # set_value for every attribute, so just treat it as an invalidation
+    def set_value(self, instance, new_value):
+        self.invalidate(instance)
+    ComputedAttribute.add_method(Method(
+        name="set_value", body=set_value
+    ))
+
+    def invalidate(self, instance):
+        if self.cache().pop(instance, None) is not None:
+            for dependent in list(DEPENDENTS.get(self.oid, ())):
+                dependent.dependency_changed(self, instance)
+    ComputedAttribute.add_method(Method(
+        name="invalidate", body=invalidate
+    ))
+
+    def dependency_changed(self, dependency, instance):
+        cached = self.cache().get(instance)
+        if cached is not None and dependency in cached[1]:
+            self.invalidate(instance)
+    ComputedAttribute.add_method(Method(
+        name="dependency_changed", body=dependency_changed
+    ))
+
+    ComputedAttribute.finalize()
+
+    # roles are bundles of attributes and methods which can be shared between
+    # unrelated classes. composing a role into a class copies its members into
+    # the class directly, so the role doesn't add anything to the mro.
+    global Role
+
+    Role = Class(name="Role", superclass=Object)
+    Role.add_attribute(Attribute(name="name"))
+    Role.add_attribute(Attribute(name="attributes", default=lambda: {}))
+    Role.add_attribute(Attribute(name="methods", default=lambda: {}))
+    Role.add_attribute(Attribute(name="required_methods", default=lambda: []))
+    Role.add_method(Method(
+        name="name", body=gen_reader("name")
+    ))
+    Role.add_method(Method(
+        name="local_attributes", body=gen_reader("attributes")
+    ))
+    Role.add_method(Method(
+        name="local_methods", body=gen_reader("methods")
+    ))
+    Role.add_method(Method(
+        name="required_methods", body=gen_reader("required_methods")
+    ))
+
+    def add_attribute(self, attr):
+        self.local_attributes()[attr.name()] = attr
+    Role.add_method(Method(
+        name="add_attribute", body=add_attribute
+    ))
+
+    def add_method(self, method):
+        self.local_methods()[method.name()] = method
+    Role.add_method(Method(
+        name="add_method", body=add_method
+    ))
+
+    def add_required_method(self, name):
+        self.required_methods().append(name)
+    Role.add_method(Method(
+        name="add_required_method", body=add_required_method
+    ))
+
+    Role.finalize()
+
 bootstrap()
+
+# finalizes a batch of classes at once. superclasses are handled before their
+# subclasses, so each class can start from its superclass's already resolved
+# method table rather than walking its entire mro again. that shortcut only
+# matches what finalize would do if the metaclass uses the default method
+# resolution, so classes whose metaclass overrides any of the methods below
+# just get their own finalize called instead.
+FINALIZE_METHODS = [ "finalize", "mro", "all_methods", "all_modifiers" ]
+
+def finalize_all(classes):
+    defaults = Class.all_methods()
+    resolved = {}
+    for c in sorted(set(classes), key=lambda c: len(c.ancestor_ids())):
+        metaclass_methods = c.metaclass.all_methods()
+        if any(metaclass_methods[name] is not defaults[name] for name in FINALIZE_METHODS):
+            c.finalize()
+            continue
+        parent = c.superclass()
+        if parent in resolved:
+            methods = dict(resolved[parent])
+            methods.update(c.local_methods())
+        else:
+            methods = c.all_methods()
+        resolved[c] = methods
+        python_install_methods(c, methods, c.all_modifiers())
+
+# takes a snapshot of the instance stats of every class with accounting
+# enabled, which can be compared against a later snapshot with
+# accounting_diff to see which classes are accumulating instances
+def accounting_snapshot():
+    snapshot = {}
+    for accounting in list(ACCOUNTING.values()):
+        c = accounting["class"]()
+        if c is not None:
+            snapshot[c] = c.instance_stats()
+    return snapshot
+
+def accounting_diff(before, after):
+    empty = { "created": 0, "live": 0, "bytes": 0 }
+    diff = {}
+    for c in after:
+        old = before.get(c, empty)
+        changes = { key: after[c][key] - old[key] for key in empty }
+        if any(changes.values()):
+            diff[c] = changes
+    return diff
+
+# columns are stored as numpy arrays if numpy is available, and otherwise as
+# python arrays for numeric data or plain lists for anything else
+def make_column(values):
+    if numpy is not None:
+        column = numpy.array(values)
+        if column.dtype.kind not in "biuf":
+            column = numpy.array(values, dtype=object)
+        return column
+    if all(type(v) == int for v in values):
+        try:
+            return array("q", values)
+        except OverflowError:
+            return list(values)
+    if all(type(v) in (int, float) for v in values):
+        return array("d", values)
+    return list(values)
+
+# whether the values can be written into the column without losing anything,
+# using the same rules that make_column uses to pick the column type
+def column_accepts(column, values):
+    if numpy is not None:
+        return numpy.can_cast(numpy.asarray(values).dtype, column.dtype, "same_kind")
+    if isinstance(column, list):
+        return True
+    if column.typecode == "d":
+        return all(type(v) in (int, float) for v in values)
+    return all(type(v) == int and -2 ** 63 <= v < 2 ** 63 for v in values)
+
+# a container for many instances of a single class, which stores each
+# attribute as a single column rather than as a separate slots dict per
+# instance. columns can be read and written all at once, and individual
+# elements are turned back into normal instances when they are pulled out
+# (as copies, so changes to them aren't written back to the collection).
+class Collection(object):
+    def __init__(self, metaclass, columns, indices=None):
+        self.metaclass = metaclass
+        self.columns = columns
+        # filtered views share their parent's columns, and only store the
+        # indices of the rows that they contain
+        self.indices = indices
+
+    def __len__(self):
+        if self.indices is not None:
+            return len(self.indices)
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def rows(self):
+        if self.indices is not None:
+            return self.indices
+        return range(len(self))
+
+    def column(self, name):
+        column = self.columns[name]
+        if self.indices is None:
+            return column
+        if numpy is not None:
+            return column[self.indices]
+        return make_column([ column[i] for i in self.indices ])
+
+    # values can be any iterable other than a string, with one value per row,
+    # or a single value to write to every row. if the column can't hold the
+    # new values as they are, it's rebuilt as a wider type which can (ints
+    # become floats, and anything else becomes a column of objects).
+    def set_column(self, name, values):
+        column = self.columns[name]
+        rows = self.rows()
+        if isinstance(values, (str, bytes)) or not hasattr(values, "__iter__"):
+            values = [ values ] * len(rows)
+        else:
+            values = list(values)
+        if values and not column_accepts(column, values):
+            merged = list(column)
+            for i, value in zip(rows, values):
+                merged[i] = value
+            self.columns[name] = make_column(merged)
+        elif numpy is not None:
+            if self.indices is None:
+                column[:] = values
+            else:
+                column[self.indices] = values
+        else:
+            for i, value in zip(rows, values):
+                column[i] = value
+
+    def filter(self, mask):
+        if numpy is not None:
+            rows = numpy.arange(len(self))
+            if self.indices is not None:
+                rows = self.indices
+            indices = rows[numpy.asarray(mask, dtype=bool)]
+        else:
+            indices = [ i for i, keep in zip(self.rows(), mask) if keep ]
+        return Collection(self.metaclass, self.columns, indices)
+
+    def __getitem__(self, i):
+        row = self.rows()[i]
+        kwargs = {}
+        for name, column in self.columns.items():
+            value = column[row]
+            if numpy is not None and isinstance(value, numpy.generic):
+                value = value.item()
+            kwargs[name] = value
+        return self.metaclass.create_instance(kwargs)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    # looks up the method once and then calls it on each element in turn
+    def apply(self, method_name, *args, **kwargs):
+        body = getattr(python_class_for(self.metaclass), method_name)
+        return [
+            body(instance, *args, **kwargs) for instance in self.elements()
+        ]
+
+    # like iterating over the collection, but if every column is stored in
+    # plain slots, the elements are built directly from the rows rather than
+    # going through create_instance, which would just copy the same values
+    # into the slots one attribute at a time. these elements are meant to be
+    # short-lived, so they also aren't counted by instance accounting.
+    def elements(self):
+        attrs = self.metaclass.all_attributes()
+        names = list(self.columns)
+        if any(attrs[name].metaclass is not Attribute for name in names):
+            for instance in self:
+                yield instance
+            return
+        python_class = python_class_for(self.metaclass)
+        columns = [ self.python_values(name) for name in names ]
+        for row in zip(*columns):
+            instance = BasicInstance(self.metaclass, dict(zip(names, row)))
+            instance.__class__ = python_class
+            yield instance
+
+    def python_values(self, name):
+        column = self.column(name)
+        if numpy is not None:
+            return column.tolist()
+        return column
@@ -1,34 +1,93 @@
 import json
+import queue
+import socket
+import socketserver
+import threading
+import weakref
 import mop
 
-class InMemoryDatabase(object):
-    def __init__(self):
-        self.store = {}
+# the parts of a database that don't care where the data actually lives.
+# subclasses provide the storage by implementing _store_many and _load_many,
+# which deal with lists of names and encoded values.
+class Database(object):
+    def __init__(self, identity_map=False, write_back_migrations=False):
         self.class_registry = {}
+        # objects stored by an older version of their class are migrated
+        # when they are looked up, and can optionally be stored again in
+        # their migrated form at the same time
+        self.write_back_migrations = write_back_migrations
+        # with an identity map, looking up an object that is still alive
+        # somewhere returns that same object rather than decoding a new copy
+        self.identity_map = None
+        if identity_map:
+            self.identity_map = weakref.WeakValueDictionary()
 
     def register_class(self, c):
         self.class_registry[c.name()] = c
 
     def insert(self, name, obj):
-        data = self._repr(obj)
-        self.store[name] = json.dumps(
-            data,
-            separators=(',', ':'),
-            sort_keys=True
-        )
+        self.insert_many([ (name, obj) ])
+
+    def insert_many(self, items):
+        reprs = [ (name, obj, self._repr(obj)) for name, obj in items ]
+        self._store_many([
+            (name, json.dumps(data, separators=(',', ':'), sort_keys=True))
+            for name, obj, data in reprs
+        ])
+        if self.identity_map is not None:
+            for name, obj, data in reprs:
+                if data["type"] == "object":
+                    self.identity_map[name] = obj
+                else:
+                    self.identity_map.pop(name, None)
 
     def lookup(self, name):
-        if name in self.store:
-            data = json.loads(self.store[name])
-            if data["type"] == "plain":
-                return data["data"]
-            elif data["type"] == "object":
-                metaclass = self.class_registry[data["class"]]
-                return metaclass.create_instance(data["data"])
+        return self.lookup_many([ name ])[0]
+
+    def lookup_many(self, names):
+        found = {}
+        missing = []
+        for name in names:
+            obj = None
+            if self.identity_map is not None:
+                obj = self.identity_map.get(name)
+            if obj is not None:
+                found[name] = obj
             else:
-                raise Exception("unknown object type")
-        else:
+                missing.append(name)
+        if missing:
+            for name, value in zip(missing, self._load_many(missing)):
+                found[name] = self._decode(name, value)
+        return [ found[name] for name in names ]
+
+    def _decode(self, name, value):
+        if value is None:
             raise Exception("object not in database")
+        data = json.loads(value)
+        if data["type"] == "plain":
+            return data["data"]
+        elif data["type"] == "object":
+            metaclass = self.class_registry[data["class"]]
+            versions = data.get("version", {})
+            if not isinstance(versions, dict):
+                # records written before superclass versions were stored
+                versions = { data["class"]: versions }
+            current_versions = metaclass.schema_versions()
+            for class_name, version in versions.items():
+                if version > current_versions.get(class_name, 0):
+                    raise Exception("object is newer than its class")
+            slots = data["data"]
+            outdated = versions != current_versions
+            if outdated:
+                slots = metaclass.migrate(slots, versions)
+            obj = metaclass.create_instance(slots, data.get("oid"))
+            if outdated and self.write_back_migrations:
+                self.insert(name, obj)
+            if self.identity_map is not None:
+                self.identity_map[name] = obj
+            return obj
+        else:
+            raise Exception("unknown object type")
 
     def _repr(self, obj):
         if type(obj) == type([]):
@@ -45,9 +104,273 @@ class InMemoryDatabase(object):
             return { "type": "plain", "data": obj }
         if hasattr(obj, 'isa') and obj.isa(mop.Object):
             self.register_class(obj.metaclass)
-            return {
+            data = {
                 "type": "object",
                 "class": obj.metaclass.name(),
                 "data": obj.slots,
+                "oid": obj.oid,
             }
+            # unversioned records are treated as version 0 of every class,
+            # so there's no need to store the versions until the class or one
+            # of its superclasses has migrations
+            versions = obj.metaclass.schema_versions()
+            if versions:
+                data["version"] = versions
+            return data
         raise Exception("unknown object type")
+
+class InMemoryDatabase(Database):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.store = {}
+
+    def _store_many(self, items):
+        for name, value in items:
+            self.store[name] = value
+
+    def _load_many(self, names):
+        return [ self.store.get(name) for name in names ]
+
+# in a real implementation, we'd add more functionality to the mop itself to
+# allow for calling superclass methods, but that would be complicated enough to
+# obscure the implementation and make it not as easy to follow (we would have
+# to manage call stacks ourselves), and so we just do this instead for now
+def call_method_at_class(c, method_name, invocant, *args, **kwargs):
+    return c.all_methods()[method_name].execute(invocant, args, kwargs)
+
+# an attribute class which keeps its values in a database rather than in the
+# instance's slots, and a metaclass which gives all of its attributes the
+# class's database. the attribute class can also be used on its own, by
+# passing the database to each attribute directly.
+def database_backed_classes():
+    DatabaseAttribute = mop.Class(
+        name="DatabaseAttribute",
+        superclass=mop.Attribute,
+    )
+    DatabaseAttribute.add_attribute(DatabaseAttribute.attribute_class()(
+        name="db",
+    ))
+    DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
+        name="db",
+        body=lambda self: self.metaclass.all_attributes()["db"].value(self)
+    ))
+    def value(self, instance):
+        key = (instance.oid, self.name())
+        return self.db().lookup(key)
+    DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
+        name="value",
+        body=value,
+    ))
+    def set_value(self, instance, new_value):
+        key = (instance.oid, self.name())
+        self.db().insert(key, new_value)
+    DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
+        name="set_value",
+        body=set_value,
+    ))
+    DatabaseAttribute.finalize()
+
+    DatabaseBackedClass = mop.Class(
+        name="DatabaseBackedClass",
+        superclass=mop.Class,
+    )
+    DatabaseBackedClass.add_attribute(DatabaseBackedClass.attribute_class()(
+        name="db",
+    ))
+    DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
+        name="db",
+        body=lambda self: self.metaclass.all_attributes()["db"].value(self)
+    ))
+    def add_attribute(self, attr):
+        attr.metaclass.all_attributes()["db"].set_value(attr, self.db())
+        call_method_at_class(mop.Class, "add_attribute", self, attr)
+    DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
+        name="add_attribute",
+        body=add_attribute,
+    ))
+    DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
+        name="attribute_class",
+        body=lambda self: DatabaseAttribute,
+    ))
+    DatabaseBackedClass.finalize()
+
+    return DatabaseAttribute, DatabaseBackedClass
+
+# a store which lives in its own thread (or process), and which any number of
+# ObjectStoreClients can share. the protocol is one json request per line,
+# answered by one json response per line, in order. names are whatever
+# strings the clients send, and values are the clients' encoded objects.
+class ObjectStoreServer(object):
+    def __init__(self, address=("127.0.0.1", 0)):
+        self.store = {}
+        self.lock = threading.Lock()
+        if isinstance(address, str):
+            server_class = socketserver.ThreadingUnixStreamServer
+        else:
+            server_class = socketserver.ThreadingTCPServer
+        self.server = server_class(address, ObjectStoreRequestHandler)
+        self.server.daemon_threads = True
+        self.server.object_store = self
+        self.address = self.server.server_address
+        self.thread = None
+        self.connections = set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # shutdown waits for serve_forever to finish, so it would block
+        # forever if the server was never started
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server.server_close()
+        # connections which are already open would otherwise carry on being
+        # served by their own threads
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def handle(self, request):
+        if request["op"] == "insert":
+            with self.lock:
+                for name, value in request["items"]:
+                    self.store[name] = value
+            return { "ok": True }
+        elif request["op"] == "lookup":
+            with self.lock:
+                values = [ self.store.get(name) for name in request["names"] ]
+            return { "values": values }
+        else:
+            return { "error": "unknown operation" }
+
+# open connections are tracked so that stopping the server can close them
+class ObjectStoreRequestHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        store = self.server.object_store
+        with store.lock:
+            store.connections.add(self.connection)
+
+    def finish(self):
+        store = self.server.object_store
+        with store.lock:
+            store.connections.discard(self.connection)
+        super().finish()
+
+    # a bad request gets an error response rather than dropping the
+    # connection, so the client can tell what went wrong
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.object_store.handle(json.loads(line))
+            except Exception as e:
+                response = { "error": "bad request: " + repr(e) }
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+
+# a database which keeps its data in an ObjectStoreServer. connections are
+# pooled and reused between calls, so it can be shared between threads, and
+# insert_many and lookup_many send a whole batch as a single request.
+class ObjectStoreClient(Database):
+    def __init__(self, address, pool_size=4, timeout=10, **kwargs):
+        super().__init__(**kwargs)
+        self.address = address
+        self.pool = queue.LifoQueue(pool_size)
+        # how long to wait for the server before giving up on a request
+        self.timeout = timeout
+
+    def close(self):
+        while True:
+            try:
+                sock, rfile = self.pool.get_nowait()
+            except queue.Empty:
+                return
+            rfile.close()
+            sock.close()
+
+    # sends all of the requests before reading any of the responses, so a
+    # batch of requests only costs a single round trip
+    def pipeline(self, requests):
+        data = b"".join(
+            json.dumps(request).encode() + b"\n" for request in requests
+        )
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            connection = None
+        if connection is not None:
+            # a pooled connection may have been closed by the server since it
+            # was last used (if the server was restarted, for instance), so
+            # it gets one retry on a fresh connection. requests only ever set
+            # or read values, so sending them again is harmless.
+            try:
+                responses = self._round_trip(connection, data, len(requests))
+            except ConnectionError:
+                connection = None
+        if connection is None:
+            connection = self._connect()
+            responses = self._round_trip(connection, data, len(requests))
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            sock, rfile = connection
+            rfile.close()
+            sock.close()
+        for response in responses:
+            if "error" in response:
+                raise Exception(response["error"])
+        return responses
+
+    # the connection is closed if anything goes wrong, since there's no way
+    # to know how much of the conversation the server saw
+    def _round_trip(self, connection, data, count):
+        sock, rfile = connection
+        try:
+            sock.sendall(data)
+            responses = []
+            for i in range(count):
+                line = rfile.readline()
+                if not line.endswith(b"\n"):
+                    raise ConnectionError("object store closed the connection")
+                responses.append(json.loads(line))
+        except:
+            rfile.close()
+            sock.close()
+            raise
+        return responses
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except:
+            sock.close()
+            raise
+        return (sock, sock.makefile("rb"))
+
+    # names can be anything json can represent (attribute storage keys are
+    # tuples, for instance), so they're sent to the server in encoded form
+    def _store_many(self, items):
+        self.pipeline([ {
+            "op": "insert",
+            "items": [ [ json.dumps(name), value ] for name, value in items ],
+        } ])
+
+    def _load_many(self, names):
+        response = self.pipeline([ {
+            "op": "lookup",
+            "names": [ json.dumps(name) for name in names ],
+        } ])[0]
+        return response["values"]
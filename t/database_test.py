@@ -49,8 +49,123 @@ class DatabaseTest(unittest.TestCase):
         assert point2.x() == 10
         assert point2.y() == 23
         assert point is not point2
+        assert point2.oid == point.oid
         assert db.store == {
             "foo": '{"data":{"a":3,"c":5},"type":"plain"}',
             "bar": '{"data":[1,2,"b"],"type":"plain"}',
-            "p": '{"class":"Point","data":{"x":10,"y":23},"type":"object"}',
+            "p": '{"class":"Point","data":{"x":10,"y":23},"oid":' + str(point.oid) + ',"type":"object"}',
         }
+
+    def test_identity_map(self):
+        db = InMemoryDatabase(identity_map=True)
+
+        Point = mop.Class(
+            name="Point",
+            superclass=mop.Class.base_object_class(),
+        )
+        Point.add_attribute(Point.attribute_class()(name="x"))
+        Point.add_method(Point.method_class()(
+            name="x",
+            body=lambda self: self.metaclass.all_attributes()["x"].value(self)
+        ))
+        Point.finalize()
+
+        point = Point(x=10)
+        db.insert("p", point)
+        assert db.lookup("p") is point
+
+        del point
+        point2 = db.lookup("p")
+        assert point2.x() == 10
+        assert db.lookup("p") is point2
+
+        db.insert("p", [1, 2])
+        assert db.lookup("p") == [1, 2]
+        assert len(db.identity_map) == 0
+
+    def test_migrations(self):
+        for write_back in [ False, True ]:
+            db = InMemoryDatabase(write_back_migrations=write_back)
+
+            Point = mop.Class.define(
+                name="Point",
+                attributes={ "x": 0, "y": 0 },
+            )
+            original = Point(x=1, y=2)
+            oid = str(original.oid)
+            db.insert("p", original)
+            del original
+            assert db.store["p"] == '{"class":"Point","data":{"x":1,"y":2},"oid":' + oid + ',"type":"object"}'
+
+            # rename x and y, and then add z
+            def rename(slots):
+                return { "left": slots["x"], "up": slots["y"] }
+            Point.add_migration(rename)
+            def add_z(slots):
+                slots["z"] = 0
+                return slots
+            Point.add_migration(add_z)
+            Point.local_attributes().clear()
+            for name in [ "left", "up", "z" ]:
+                Point.add_attribute(Point.attribute_class()(name=name, default=0))
+            Point.finalize()
+            assert Point.schema_version() == 2
+
+            point = db.lookup("p")
+            assert point.slots == { "left": 1, "up": 2, "z": 0 }
+            if write_back:
+                assert db.store["p"] == '{"class":"Point","data":{"left":1,"up":2,"z":0},"oid":' + oid + ',"type":"object","version":{"Point":2}}'
+            else:
+                assert db.store["p"] == '{"class":"Point","data":{"x":1,"y":2},"oid":' + oid + ',"type":"object"}'
+            assert db.lookup("p").slots == { "left": 1, "up": 2, "z": 0 }
+
+            point = Point(left=5)
+            db.insert("q", point)
+            assert db.store["q"] == '{"class":"Point","data":{"left":5,"up":0,"z":0},"oid":' + str(point.oid) + ',"type":"object","version":{"Point":2}}'
+            assert db.lookup("q").slots == { "left": 5, "up": 0, "z": 0 }
+
+    def test_superclass_migrations(self):
+        db = InMemoryDatabase()
+
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0 },
+        )
+        Point3D = mop.Class.define(
+            name="Point3D",
+            superclass=Point,
+            attributes={ "z": 0 },
+        )
+        db.insert("p", Point3D(x=1, z=3))
+
+        # a migration in the subclass, and then one in the superclass
+        def rename_z(slots):
+            slots["depth"] = slots.pop("z")
+            return slots
+        Point3D.add_migration(rename_z)
+        Point3D.local_attributes().clear()
+        Point3D.add_attribute(Point3D.attribute_class()(name="depth", default=0))
+        Point3D.finalize()
+        db.insert("q", Point3D(x=2, depth=4))
+
+        def rename_x(slots):
+            slots["left"] = slots.pop("x")
+            return slots
+        Point.add_migration(rename_x)
+        Point.local_attributes().clear()
+        Point.add_attribute(Point.attribute_class()(name="left", default=0))
+        Point.finalize()
+        Point3D.finalize()
+        assert Point3D.schema_versions() == { "Point": 1, "Point3D": 1 }
+
+        assert db.lookup("p").slots == { "left": 1, "depth": 3 }
+        assert db.lookup("q").slots == { "left": 2, "depth": 4 }
+        assert '"version":{"Point3D":1}' in db.store["q"]
+
+        db.insert("r", Point3D(left=5, depth=6))
+        assert '"version":{"Point":1,"Point3D":1}' in db.store["r"]
+        assert db.lookup("r").slots == { "left": 5, "depth": 6 }
+
+        # records written before superclass versions were stored
+        db.store["s"] = db.store["q"].replace('{"Point3D":1}', '1')
+        assert db.lookup("s").slots == { "left": 2, "depth": 4 }
@@ -1,4 +1,10 @@
 import unittest
+import unittest.mock
+
+import gc
+import os
+import subprocess
+import sys
 
 import mop
 
@@ -123,3 +129,465 @@ class MopTest(unittest.TestCase):
         point3d_default = Point3D()
         assert point3d_default.x() == 0
         assert point3d_default.y() == 0
+
+    def test_isa_hierarchy(self):
+        classes = [ mop.Object ]
+        for i in range(100):
+            c = mop.Class(name="C" + str(i), superclass=classes[-1])
+            c.finalize()
+            classes.append(c)
+
+        deepest = classes[-1]()
+        for c in classes:
+            assert deepest.isa(c)
+        assert not deepest.isa(mop.Class)
+        assert not classes[50]().isa(classes[51])
+        assert classes[-1].ancestor_ids() == { c.oid for c in classes[-1].mro() }
+
+        Other = mop.Class(name="Other", superclass=mop.Object)
+        Other.finalize()
+        classes[50].set_superclass(Other)
+
+        assert deepest.isa(classes[50])
+        assert deepest.isa(Other)
+        assert not deepest.isa(classes[49])
+        assert not deepest.isa(classes[1])
+        assert deepest.isa(mop.Object)
+        assert classes[49]().isa(classes[1])
+        assert classes[-1].ancestor_ids() == { c.oid for c in classes[-1].mro() }
+
+        assert not deepest.isa(None)
+        assert not deepest.isa(1)
+
+        # subclasses don't keep themselves alive by registering with their
+        # superclass, and their cached ancestors go away along with them
+        temporary_oids = []
+        for i in range(10):
+            Temporary = mop.Class(name="Temporary", superclass=Other)
+            Temporary.finalize()
+            assert Temporary().isa(Other)
+            temporary_oids.append(Temporary.oid)
+        del Temporary
+        gc.collect()
+        assert list(Other.subclasses()) == [ classes[50] ]
+        for oid in temporary_oids:
+            assert oid not in mop.ANCESTORS
+            assert oid not in mop.CACHED_CLASSES
+
+    def test_define(self):
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0, "y": 0 },
+            methods={
+                "x": lambda self: self.metaclass.all_attributes()["x"].value(self),
+                "y": lambda self: self.metaclass.all_attributes()["y"].value(self),
+            },
+        )
+        assert Point.superclass() is mop.Object
+        assert Point.name() == "Point"
+
+        point = Point(x=1)
+        assert point.isa(Point)
+        assert point.x() == 1
+        assert point.y() == 0
+
+        Point3D = mop.Class.define(
+            name="Point3D",
+            superclass=Point,
+            attributes={ "z": 0 },
+            methods={
+                "z": lambda self: self.metaclass.all_attributes()["z"].value(self),
+            },
+        )
+        point3d = Point3D(x=1, z=3)
+        assert point3d.isa(Point)
+        assert point3d.x() == 1
+        assert point3d.z() == 3
+
+        # a metaclass whose finalize fails only after the new class has been
+        # registered with its superclass and had its methods installed
+        created = []
+        def broken_finalize(self):
+            created.append(self)
+            self.ancestor_ids()
+            mop.Class.all_methods()["finalize"].execute(self, (), {})
+            raise Exception("broken")
+        BrokenClass = mop.Class.define(
+            name="BrokenClass",
+            superclass=mop.Class,
+            methods={ "finalize": broken_finalize },
+        )
+        self.assertRaises(Exception, BrokenClass.define,
+            name="Broken",
+            superclass=Point,
+            attributes={ "w": 0 },
+        )
+        broken = created[0]
+        assert broken not in Point.subclasses()
+        assert broken.oid not in mop.UNDERLYING_CLASSES
+        assert broken.oid not in mop.ANCESTORS
+        assert list(Point.subclasses()) == [ Point3D ]
+
+    def test_finalize_all(self):
+        Point = mop.Class(name="Point", superclass=mop.Object)
+        Point3D = mop.Class(name="Point3D", superclass=Point)
+        Point4D = mop.Class(name="Point4D", superclass=Point3D)
+        for c, attr_name in [ (Point, "x"), (Point3D, "z"), (Point4D, "w") ]:
+            c.add_attribute(c.attribute_class()(name=attr_name, default=0))
+            c.add_method(c.method_class()(
+                name=attr_name,
+                body=lambda self, attr_name=attr_name: self.metaclass.all_attributes()[attr_name].value(self)
+            ))
+        Point3D.around("x", lambda orig, self: orig(self) * 2)
+
+        mop.finalize_all([ Point4D, Point, Point3D ])
+
+        point4d = Point4D(x=1, z=2, w=3)
+        assert point4d.x() == 2
+        assert point4d.z() == 2
+        assert point4d.w() == 3
+        assert point4d.isa(mop.Object)
+        assert Point(x=1).x() == 1
+        assert not Point(x=1).can("z")
+
+        # metaclasses which change how methods are resolved aren't bypassed
+        def all_methods(self):
+            methods = mop.Class.all_methods()["all_methods"].execute(self, (), {})
+            methods["greet"] = self.method_class()(
+                name="greet", body=lambda self: "hello"
+            )
+            return methods
+        GreetingClass = mop.Class.define(
+            name="GreetingClass",
+            superclass=mop.Class,
+            methods={ "all_methods": all_methods },
+        )
+        Greeter = GreetingClass(name="Greeter", superclass=mop.Object)
+        Greeter2 = GreetingClass(name="Greeter2", superclass=Greeter)
+        Greeter3 = mop.Class(name="Greeter3", superclass=Greeter2)
+        mop.finalize_all([ Greeter, Greeter2, Greeter3 ])
+        assert Greeter().greet() == "hello"
+        assert Greeter2().greet() == "hello"
+        assert not Greeter3().can("greet")
+
+    def test_computed_attributes(self):
+        evaluations = []
+
+        Point = mop.Class(
+            name="Point",
+            superclass=mop.Class.base_object_class()
+        )
+        Point.add_attribute(Point.attribute_class()(name="x", default=0))
+        Point.add_attribute(Point.attribute_class()(name="y", default=0))
+        Point.add_attribute(Point.attribute_class()(name="label", default=""))
+        def norm_squared(self):
+            evaluations.append("norm_squared")
+            return self.x() ** 2 + self.y() ** 2
+        Point.add_attribute(Point.computed_attribute_class()(
+            name="norm_squared", body=norm_squared
+        ))
+        def is_unit(self):
+            evaluations.append("is_unit")
+            return self.norm_squared() == 1
+        Point.add_attribute(Point.computed_attribute_class()(
+            name="is_unit", body=is_unit
+        ))
+        for name in [ "x", "y", "label", "norm_squared", "is_unit" ]:
+            Point.add_method(Point.method_class()(
+                name=name,
+                body=lambda self, name=name: self.metaclass.all_attributes()[name].value(self)
+            ))
+        def set_value(name):
+            return lambda self, new_value: self.metaclass.all_attributes()[name].set_value(self, new_value)
+        Point.add_method(Point.method_class()(name="set_x", body=set_value("x")))
+        Point.add_method(Point.method_class()(name="set_label", body=set_value("label")))
+        Point.finalize()
+
+        # attributes only pay for dependency tracking once a computed
+        # attribute of their class has been evaluated
+        x = Point.all_attributes()["x"]
+        assert type(x) is mop.python_class_for(mop.Attribute)
+
+        point = Point(x=3, y=4)
+        assert "norm_squared" not in point.slots
+        assert point.norm_squared() == 25
+        assert point.norm_squared() == 25
+        assert evaluations == ["norm_squared"]
+
+        point.set_label("origin")
+        assert point.norm_squared() == 25
+        assert evaluations == ["norm_squared"]
+
+        point.set_x(0)
+        assert point.norm_squared() == 16
+        assert evaluations == ["norm_squared", "norm_squared"]
+
+        assert not point.is_unit()
+        assert not point.is_unit()
+        assert evaluations == ["norm_squared", "norm_squared", "is_unit"]
+
+        point.set_x(1)
+        point2 = Point(x=1)
+        assert point2.is_unit()
+        assert not point.is_unit()
+        assert evaluations == [
+            "norm_squared", "norm_squared", "is_unit",
+            "is_unit", "norm_squared", "is_unit", "norm_squared",
+        ]
+        assert type(x) is not mop.python_class_for(mop.Attribute)
+        assert type(mop.Class.all_attributes()["name"]) is mop.python_class_for(mop.Attribute)
+
+        # the dependency records go away along with the classes involved
+        oids = []
+        for i in range(10):
+            Temporary = mop.Class.define(
+                name="Temporary",
+                attributes={ "x": 0 },
+                methods={
+                    "x": lambda self: self.metaclass.all_attributes()["x"].value(self),
+                },
+            )
+            Temporary.add_attribute(Temporary.computed_attribute_class()(
+                name="double", body=lambda self: self.x() * 2
+            ))
+            assert Temporary.all_attributes()["double"].value(Temporary(x=i)) == i * 2
+            oids.append(Temporary.all_attributes()["x"].oid)
+            assert oids[-1] in mop.DEPENDENTS
+        del Temporary
+        gc.collect()
+        for oid in oids:
+            assert oid not in mop.DEPENDENTS
+
+    def test_instance_accounting(self):
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0, "y": 0 },
+        )
+        assert Point.instance_stats() is None
+        Point()
+
+        Point.enable_accounting()
+        before = mop.accounting_snapshot()
+        assert before[Point] == { "created": 0, "live": 0, "bytes": 0 }
+
+        points = [ Point(x=i) for i in range(10) ]
+        Point()
+        stats = Point.instance_stats()
+        assert stats["created"] == 11
+        assert stats["live"] == 10
+        assert stats["bytes"] > 0
+
+        del points[5:]
+        after = mop.accounting_snapshot()
+        diff = mop.accounting_diff(before, after)
+        assert list(diff.keys()) == [ Point ]
+        assert diff[Point]["created"] == 11
+        assert diff[Point]["live"] == 5
+        assert mop.accounting_diff(after, mop.accounting_snapshot()) == {}
+
+        Point.disable_accounting()
+        Point()
+        assert Point.instance_stats() is None
+        assert Point not in mop.accounting_snapshot()
+
+    @unittest.skipIf(mop.numpy is None, "numpy is not installed")
+    def test_collection_numpy(self):
+        self.check_collection()
+
+    def test_collection_without_numpy(self):
+        with unittest.mock.patch.object(mop, "numpy", None):
+            self.check_collection()
+
+    def check_collection(self):
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0, "y": 0 },
+            methods={
+                "x": lambda self: self.metaclass.all_attributes()["x"].value(self),
+                "y": lambda self: self.metaclass.all_attributes()["y"].value(self),
+                "sum": lambda self, scale=1: (self.x() + self.y()) * scale,
+            },
+        )
+
+        points = Point.collection([ Point(x=i, y=i * 2) for i in range(5) ])
+        assert len(points) == 5
+        assert list(points.column("x")) == [ 0, 1, 2, 3, 4 ]
+        assert list(points.column("y")) == [ 0, 2, 4, 6, 8 ]
+
+        point = points[3]
+        assert point.isa(Point)
+        assert point.x() == 3
+        assert point.y() == 6
+        assert [ p.x() for p in points ] == [ 0, 1, 2, 3, 4 ]
+        assert points.apply("sum", scale=2) == [ 0, 6, 12, 18, 24 ]
+        assert [ type(x) for x in points.apply("x") ] == [ int ] * 5
+
+        big = points.filter([ x > 1 for x in points.column("x") ])
+        assert len(big) == 3
+        assert list(big.column("x")) == [ 2, 3, 4 ]
+        assert big[0].x() == 2
+
+        big.set_column("y", 0)
+        assert list(points.column("y")) == [ 0, 2, 0, 0, 0 ]
+        big.set_column("x", [ 7, 8, 9 ])
+        assert list(points.column("x")) == [ 0, 1, 7, 8, 9 ]
+
+        odd = big.filter([ x % 2 == 1 for x in big.column("x") ])
+        assert list(odd.column("x")) == [ 7, 9 ]
+        assert odd.apply("sum") == [ 7, 9 ]
+
+        # writing values which don't fit the column's current type widens it
+        # rather than truncating them
+        odd.set_column("x", [ 1.5, 2.5 ])
+        assert list(points.column("x")) == [ 0, 1, 1.5, 8, 2.5 ]
+        assert points[0].x() == 0
+        assert points[2].x() == 1.5
+        points.set_column("y", [ "a", 1, None, 2.5, "b" ])
+        assert list(points.column("y")) == [ "a", 1, None, 2.5, "b" ]
+
+        # and any iterable works as a sequence of values
+        points.set_column("x", range(10, 15))
+        assert list(points.column("x")) == [ 10, 11, 12, 13, 14 ]
+        big.set_column("y", (i * 2 for i in range(3)))
+        assert list(points.column("y")) == [ "a", 1, 0, 2, 4 ]
+
+        defaults = Point.collection(columns={ "x": [ 1, 2 ] })
+        assert list(defaults.column("y")) == [ 0, 0 ]
+        assert defaults[1].x() == 2
+
+    def test_roles(self):
+        Comparable = mop.Role(name="Comparable")
+        Comparable.add_required_method("compare")
+        Comparable.add_method(Comparable.metaclass.method_class()(
+            name="equals",
+            body=lambda self, other: self.compare(other) == 0
+        ))
+
+        Labeled = mop.Role(name="Labeled")
+        Labeled.add_attribute(mop.Attribute(name="label", default=""))
+        Labeled.add_method(Labeled.metaclass.method_class()(
+            name="label",
+            body=lambda self: self.metaclass.all_attributes()["label"].value(self)
+        ))
+        Labeled.add_method(Labeled.metaclass.method_class()(
+            name="equals",
+            body=lambda self, other: self.label() == other.label()
+        ))
+
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0 },
+            methods={
+                "x": lambda self: self.metaclass.all_attributes()["x"].value(self),
+            },
+        )
+        self.assertRaises(Exception, Point.add_role, Comparable)
+
+        Point.add_method(Point.method_class()(
+            name="compare",
+            body=lambda self, other: self.x() - other.x()
+        ))
+        Point.add_role(Comparable)
+        self.assertRaises(Exception, Point.add_role, Labeled)
+        assert "label" not in Point.local_attributes()
+
+        Point.add_method(Point.method_class()(
+            name="equals",
+            body=lambda self, other: self.x() == other.x()
+        ))
+        Point.add_role(Labeled)
+        Point.finalize()
+
+        assert Point.mro() == [ Point, mop.Object ]
+        point = Point(x=1, label="a")
+        assert point.label() == "a"
+        assert point.equals(Point(x=1, label="b"))
+        assert point.does(Comparable)
+        assert point.does(Labeled)
+        assert not mop.Object.does(Comparable)
+
+        Point3D = mop.Class.define(name="Point3D", superclass=Point)
+        assert Point3D().does(Labeled)
+
+        Sortable = mop.Role(name="Sortable")
+        Point.add_role(Sortable)
+        assert Point3D().does(Sortable)
+        assert not Point3D().does(None)
+
+        # roles can share methods, and attributes follow the same rules as
+        # methods: the class's own win, and different ones from two roles
+        # conflict
+        hello = mop.Method(name="hello", body=lambda self: "hello")
+        Greeting = mop.Role(name="Greeting")
+        Greeting.add_method(hello)
+        Greeting.add_attribute(mop.Attribute(name="x", default=5))
+        Welcome = mop.Role(name="Welcome")
+        Welcome.add_method(hello)
+        Welcome.add_attribute(mop.Attribute(name="greeting", default="hi"))
+        Farewell = mop.Role(name="Farewell")
+        Farewell.add_attribute(mop.Attribute(name="greeting", default="bye"))
+
+        x = Point.local_attributes()["x"]
+        Point.add_role(Greeting)
+        Point.add_role(Welcome)
+        assert Point.local_attributes()["x"] is x
+        self.assertRaises(Exception, Point.add_role, Farewell)
+        Point.finalize()
+        assert Point().hello() == "hello"
+        assert Point().x() == 0
+        assert Point().slots["greeting"] == "hi"
+
+        Point3D.add_role(Farewell)
+        assert Point3D().slots["greeting"] == "bye"
+
+    def test_object_ids(self):
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0 },
+        )
+        point = Point()
+        point2 = Point()
+        assert type(point.oid) == int
+        assert point.oid != point2.oid
+        assert Point.oid != mop.Class.oid
+
+        oid = point2.oid
+        del point2
+        assert Point().oid > oid
+
+        assert 0 < point.oid < 2 ** 63
+
+        previous = mop.set_oid_allocator(iter(range(1000000, 1000010)).__next__)
+        try:
+            assert Point().oid == 1000000
+            assert Point().oid == 1000001
+        finally:
+            mop.set_oid_allocator(previous)
+        assert Point().oid > oid
+
+        # separate processes don't hand out the same ids
+        script = "import mop; print(mop.Object.create_instance({}).oid)"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        oids = set()
+        for i in range(2):
+            oids.add(subprocess.check_output(
+                [ sys.executable, "-c", script ], cwd=root
+            ))
+        assert len(oids) == 2
+
+        # and neither do forked children
+        if hasattr(os, "fork"):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.write(write_fd, str(Point().oid).encode())
+                    os._exit(0)
+                finally:
+                    os._exit(1)
+            _, status = os.waitpid(pid, 0)
+            assert status == 0
+            child_oid = int(os.read(read_fd, 100))
+            os.close(read_fd)
+            os.close(write_fd)
+            assert child_oid >> 32 != Point().oid >> 32
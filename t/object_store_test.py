@@ -0,0 +1,219 @@
+import unittest
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+import mop
+
+from . import ObjectStoreServer, ObjectStoreClient, database_backed_classes
+
+# the database backed class from overrides_test, pointed at whichever
+# database it's given
+def database_backed_point_class(db):
+    _, DatabaseBackedClass = database_backed_classes()
+    Point = DatabaseBackedClass(
+        name="Point",
+        superclass=DatabaseBackedClass.base_object_class(),
+        db=db,
+    )
+    Point.add_attribute(Point.attribute_class()(name="x", default=0))
+    Point.add_attribute(Point.attribute_class()(name="y", default=0))
+    Point.add_method(Point.method_class()(
+        name="x",
+        body=lambda self: self.metaclass.all_attributes()["x"].value(self)
+    ))
+    Point.add_method(Point.method_class()(
+        name="y",
+        body=lambda self: self.metaclass.all_attributes()["y"].value(self)
+    ))
+    Point.finalize()
+    return Point
+
+# run in a separate process by test_database_backed_workers
+def run_worker(host, port, n):
+    db = ObjectStoreClient((host, port))
+    Point = database_backed_point_class(db)
+    points = [ Point(x=n * 100 + i, y=-i) for i in range(5) ]
+    print(json.dumps([ [ p.oid, p.x(), p.y() ] for p in points ]))
+    db.close()
+
+class ObjectStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ObjectStoreServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_client(self):
+        db = ObjectStoreClient(self.server.address)
+
+        db.insert("foo", {"a": 1, "b": 2})
+        assert db.lookup("foo") == {"a": 1, "b": 2}
+        db.insert((1, "x"), [1, 2, "b"])
+        assert db.lookup((1, "x")) == [1, 2, "b"]
+        self.assertRaises(Exception, db.lookup, "bar")
+
+        Point = mop.Class.define(
+            name="Point",
+            attributes={ "x": 0, "y": 0 },
+            methods={
+                "x": lambda self: self.metaclass.all_attributes()["x"].value(self),
+            },
+        )
+        db.insert_many([ ("p" + str(i), Point(x=i)) for i in range(10) ])
+        points = db.lookup_many([ "p" + str(i) for i in range(10) ])
+        assert [ p.x() for p in points ] == list(range(10))
+
+        # other clients share the same data, but need to know the classes
+        db2 = ObjectStoreClient(self.server.address)
+        db2.register_class(Point)
+        assert db2.lookup("p3").x() == 3
+        assert db2.lookup("foo") == {"a": 1, "b": 2}
+
+        responses = db.pipeline([
+            { "op": "lookup", "names": [ '"foo"' ] },
+            { "op": "lookup", "names": [ '"bar"' ] },
+        ])
+        assert responses == [
+            { "values": [ '{"data":{"a":1,"b":2},"type":"plain"}' ] },
+            { "values": [ None ] },
+        ]
+
+        db.close()
+        db2.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), "store.sock")
+        server = ObjectStoreServer(path)
+        server.start()
+        try:
+            db = ObjectStoreClient(path)
+            db.insert("foo", [1, 2])
+            assert db.lookup("foo") == [1, 2]
+            db.close()
+        finally:
+            server.stop()
+            os.unlink(path)
+
+    def test_concurrent_clients(self):
+        shared = ObjectStoreClient(self.server.address, pool_size=2)
+        errors = []
+        def worker(n):
+            try:
+                db = shared if n % 2 else ObjectStoreClient(self.server.address)
+                names = [ (n, i) for i in range(50) ]
+                db.insert_many([ (name, list(name)) for name in names ])
+                for i in range(50):
+                    db.insert((n, "single", i), i)
+                assert db.lookup_many(names) == [ list(name) for name in names ]
+                assert db.lookup((n, "single", 49)) == 49
+                if db is not shared:
+                    db.close()
+            except Exception as e:
+                errors.append(e)
+        threads = [ threading.Thread(target=worker, args=(n,)) for n in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(self.server.store) == 8 * 100
+        shared.close()
+
+    def test_database_backed_workers(self):
+        host, port = self.server.address
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        workers = [
+            subprocess.Popen(
+                [
+                    sys.executable, "-c",
+                    "from t.object_store_test import run_worker; " +
+                    "run_worker(%r, %d, %d)" % (host, port, n),
+                ],
+                cwd=root,
+                stdout=subprocess.PIPE,
+            )
+            for n in range(2)
+        ]
+        results = []
+        for worker in workers:
+            output, _ = worker.communicate()
+            assert worker.returncode == 0
+            results.extend(json.loads(output))
+
+        # both workers used the same attribute names, so their points would
+        # overwrite each other's values if their oids ever collided
+        assert len(self.server.store) == 2 * 5 * 2
+        db = ObjectStoreClient(self.server.address)
+        for oid, x, y in results:
+            assert db.lookup((oid, "x")) == x
+            assert db.lookup((oid, "y")) == y
+        db.close()
+
+    def test_stop_without_start(self):
+        server = ObjectStoreServer()
+        server.stop()
+
+    def test_bad_requests(self):
+        db = ObjectStoreClient(self.server.address)
+        self.assertRaises(Exception, db.pipeline, [ { "op": "insert" } ])
+        self.assertRaises(Exception, db.pipeline, [ { "op": "frobnicate" } ])
+        # the connection is still usable afterwards
+        db.insert("foo", [1, 2])
+        assert db.lookup("foo") == [1, 2]
+        assert db.pool.qsize() == 1
+        db.close()
+
+    def test_server_restart(self):
+        path = os.path.join(tempfile.mkdtemp(), "store.sock")
+        server = ObjectStoreServer(path)
+        server.start()
+        db = ObjectStoreClient(path)
+        try:
+            db.insert("foo", [1, 2])
+            server.stop()
+            os.unlink(path)
+            server = ObjectStoreServer(path)
+            server.start()
+            # the pooled connection is stale, so a fresh one is used
+            db.insert("foo", [3, 4])
+            assert db.lookup("foo") == [3, 4]
+            assert server.store == { '"foo"': '{"data":[3,4],"type":"plain"}' }
+        finally:
+            db.close()
+            server.stop()
+            os.unlink(path)
+
+    def test_connection_failures(self):
+        # a server which never answers
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        try:
+            db = ObjectStoreClient(listener.getsockname(), timeout=0.1)
+            self.assertRaises(socket.timeout, db.lookup, "foo")
+        finally:
+            listener.close()
+
+        # and one which hangs up without answering
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        def hang_up():
+            connection, _ = listener.accept()
+            connection.recv(1024)
+            connection.close()
+        thread = threading.Thread(target=hang_up)
+        thread.start()
+        try:
+            db = ObjectStoreClient(listener.getsockname(), timeout=1)
+            self.assertRaises(ConnectionError, db.lookup, "foo")
+        finally:
+            thread.join()
+            listener.close()
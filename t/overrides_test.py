@@ -2,14 +2,7 @@ import unittest
 
 import mop
 
-from . import InMemoryDatabase
-
-# in a real implementation, we'd add more functionality to the mop itself to
-# allow for calling superclass methods, but that would be complicated enough to
-# obscure the implementation and make it not as easy to follow (we would have
-# to manage call stacks ourselves), and so we just do this instead for now
-def call_method_at_class(c, method_name, invocant, *args, **kwargs):
-    return c.all_methods()[method_name].execute(invocant, args, kwargs)
+from . import InMemoryDatabase, call_method_at_class, database_backed_classes
 
 class OverridesTest(unittest.TestCase):
     def test_accessor_generation(self):
@@ -93,56 +86,7 @@ class OverridesTest(unittest.TestCase):
         assert methods_called == ['x', 'y']
 
     def test_db_backed_object(self):
-        DatabaseAttribute = mop.Class(
-            name="DatabaseAttribute",
-            superclass=mop.Attribute,
-        )
-        DatabaseAttribute.add_attribute(DatabaseAttribute.attribute_class()(
-            name="db",
-        ))
-        DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
-            name="db",
-            body=lambda self: self.metaclass.all_attributes()["db"].value(self)
-        ))
-        def value(self, instance):
-            key = str(hash(instance)) + ":" + self.name()
-            return self.db().lookup(key)
-        DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
-            name="value",
-            body=value,
-        ))
-        def set_value(self, instance, new_value):
-            key = str(hash(instance)) + ":" + self.name()
-            self.db().insert(key, new_value)
-        DatabaseAttribute.add_method(DatabaseAttribute.method_class()(
-            name="set_value",
-            body=set_value,
-        ))
-        DatabaseAttribute.finalize()
-
-        DatabaseBackedClass = mop.Class(
-            name="DatabaseBackedClass",
-            superclass=mop.Class,
-        )
-        DatabaseBackedClass.add_attribute(DatabaseBackedClass.attribute_class()(
-            name="db",
-        ))
-        DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
-            name="db",
-            body=lambda self: self.metaclass.all_attributes()["db"].value(self)
-        ))
-        def add_attribute(self, attr):
-            attr.metaclass.all_attributes()["db"].set_value(attr, self.db())
-            call_method_at_class(mop.Class, "add_attribute", self, attr)
-        DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
-            name="add_attribute",
-            body=add_attribute,
-        ))
-        DatabaseBackedClass.add_method(DatabaseBackedClass.method_class()(
-            name="attribute_class",
-            body=lambda self: DatabaseAttribute,
-        ))
-        DatabaseBackedClass.finalize()
+        DatabaseAttribute, DatabaseBackedClass = database_backed_classes()
 
         Point = DatabaseBackedClass(
             name="Point",
@@ -183,3 +127,106 @@ class OverridesTest(unittest.TestCase):
         assert point2.y() == -5
         assert point2.slots == {}
         assert len(Point.db().store) == 4
+
+    def test_method_modifiers(self):
+        calls = []
+
+        Point = mop.Class(
+            name="Point",
+            superclass=mop.Class.base_object_class(),
+        )
+        Point.add_attribute(Point.attribute_class()(name="x", default=0))
+        Point.add_method(Point.method_class()(
+            name="x",
+            body=lambda self: self.metaclass.all_attributes()["x"].value(self)
+        ))
+        Point.add_method(Point.method_class()(
+            name="scaled_x",
+            body=lambda self, factor: self.x() * factor
+        ))
+        Point.before("scaled_x", lambda self, factor: calls.append("before 1"))
+        Point.before("scaled_x", lambda self, factor: calls.append("before 2"))
+        Point.after("scaled_x", lambda self, factor: calls.append("after 1"))
+        Point.after("scaled_x", lambda self, factor: calls.append("after 2"))
+        def around(orig, self, factor):
+            calls.append("around")
+            return orig(self, factor + 1) + 1
+        Point.around("scaled_x", around)
+        Point.finalize()
+
+        point = Point(x=3)
+        assert point.scaled_x(2) == 10
+        assert calls == ["before 2", "before 1", "around", "after 1", "after 2"]
+
+        Point3D = mop.Class(
+            name="Point3D",
+            superclass=Point,
+        )
+        Point3D.around("scaled_x", lambda orig, self, factor: -orig(self, factor))
+        Point3D.finalize()
+
+        del calls[:]
+        point3d = Point3D(x=3)
+        assert point3d.scaled_x(2) == -10
+        assert calls == ["before 2", "before 1", "around", "after 1", "after 2"]
+
+        Point4D = mop.Class(
+            name="Point4D",
+            superclass=Point,
+        )
+        Point4D.add_method(Point4D.method_class()(
+            name="scaled_x",
+            body=lambda self, factor: self.x() - factor
+        ))
+        Point4D.finalize()
+
+        del calls[:]
+        point4d = Point4D(x=3)
+        assert point4d.scaled_x(2) == 1
+        assert calls == []
+
+        Broken = mop.Class(
+            name="Broken",
+            superclass=mop.Class.base_object_class(),
+        )
+        Broken.before("missing", lambda self: None)
+        self.assertRaises(Exception, Broken.finalize)
+
+    def test_computed_over_overridden_attribute(self):
+        # the same database backed attribute as above, but without the
+        # metaclass, so that it can be mixed with other kinds of attribute
+        DatabaseAttribute, _ = database_backed_classes()
+
+        db = InMemoryDatabase()
+        Point = mop.Class(
+            name="Point",
+            superclass=mop.Class.base_object_class(),
+        )
+        Point.add_attribute(DatabaseAttribute(name="x", default=1, db=db))
+        Point.add_attribute(Point.computed_attribute_class()(
+            name="dbl",
+            body=lambda self: self.x() * 2,
+        ))
+        Point.add_method(Point.method_class()(
+            name="x",
+            body=lambda self: self.metaclass.all_attributes()["x"].value(self)
+        ))
+        Point.add_method(Point.method_class()(
+            name="dbl",
+            body=lambda self: self.metaclass.all_attributes()["dbl"].value(self)
+        ))
+        Point.add_method(Point.method_class()(
+            name="set_x",
+            body=lambda self, new_value: self.metaclass.all_attributes()["x"].set_value(self, new_value)
+        ))
+        Point.finalize()
+
+        point = Point()
+        assert point.slots == {}
+        assert point.dbl() == 2
+        point.set_x(5)
+        assert point.dbl() == 10
+
+        # collections can't build elements straight from the columns here,
+        # since x isn't stored in the slots
+        assert Point.collection([ point ]).apply("dbl") == [ 10 ]